@@ -1,5 +1,5 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, RedirectResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -9,15 +9,14 @@ import os
 import uuid
 import json
 import asyncio
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List, Optional
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from typing import List, Literal, Optional
+from pydantic import BaseModel
 import boto3
 from botocore.exceptions import ClientError
-import tempfile
-import shutil
+import hashlib
+import aiofiles
 
 from video_processor import VideoProcessor
 from database import DatabaseManager
@@ -28,7 +27,8 @@ load_dotenv()
 app = FastAPI(
     title="FlyBrain Video Processing API",
     description="API for processing videos and generating depth heatmaps",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 app.add_middleware(
@@ -48,17 +48,31 @@ video_processor = VideoProcessor()
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
 S3_BUCKET = os.getenv("S3_BUCKET", "fly-brain-img01")
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+UPLOAD_CHUNK_SIZE = 1 << 20
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "64"))
+FLYGO_DIR = os.path.join("..", "FlyGo")
+FLYGO_BIN = os.getenv("FLYGO_BIN", "/usr/local/bin/flygo")
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs("output", exist_ok=True)
 
+class FrameRecord(BaseModel):
+    frame_number: int
+    s3_path: Optional[str] = None
+    status: Literal["pending", "processing", "completed", "done", "failed"] = "pending"
+    frame_id: Optional[uuid.UUID] = None
+
 @app.on_event("startup")
 async def startup_event():
+    # Backs asyncio.to_thread and aiofiles; sized for concurrent blocking S3/disk I/O
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS))
     await db_manager.connect()
+    await video_processor.start()
     print("FlyBrain API started successfully!")
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    await video_processor.close()
     await db_manager.close()
     print("FlyBrain API shutdown complete!")
 
@@ -89,23 +103,39 @@ async def upload_video(
     temp_filename = f"{job_id}{file_extension}"
     temp_path = os.path.join(UPLOAD_DIR, temp_filename)
     
+    hasher = hashlib.sha256()
     try:
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async with aiofiles.open(temp_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                await buffer.write(chunk)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
     
+    content_sha256 = hasher.hexdigest()
+    cached_heatmap_path = await db_manager.find_completed_heatmap(content_sha256, fps)
+    
     job_data = {
         "job_id": job_id,
         "original_filename": file.filename,
         "file_path": temp_path,
         "fps": fps,
-        "status": "uploaded",
+        "status": "completed" if cached_heatmap_path else "uploaded",
+        "content_sha256": content_sha256,
+        "heatmap_video_path": cached_heatmap_path,
         "created_at": datetime.now()
     }
     
     await db_manager.create_job(job_data)
     
+    if cached_heatmap_path:
+        return {
+            "job_id": job_id,
+            "message": "Identical video already processed. Reusing existing heatmap.",
+            "status": "completed",
+            "original_filename": file.filename
+        }
+    
     background_tasks.add_task(process_video, job_id, temp_path, fps)
     
     return {
@@ -116,9 +146,27 @@ async def upload_video(
     }
 
 @app.get("/api/jobs")
-async def list_jobs(limit: int = 10, offset: int = 0):
-    jobs = await db_manager.get_jobs(limit, offset)
-    return {"jobs": jobs, "total": len(jobs)}
+async def list_jobs(limit: int = 10, cursor: Optional[str] = None):
+    before = None
+    if cursor:
+        # Cursor is "<created_at ISO>,<job_id>"; created_at is a naive TIMESTAMP column
+        try:
+            created_at_str, job_id_str = cursor.rsplit(",", 1)
+            before = (datetime.fromisoformat(created_at_str), uuid.UUID(job_id_str))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        
+        if before[0].tzinfo is not None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    jobs_json, last, page_size = await db_manager.get_jobs_json(limit, before)
+    total = await db_manager.estimate_job_count()
+    next_cursor = None
+    if last and page_size == limit:
+        next_cursor = f"{last[0].isoformat()},{last[1]}"
+    
+    content = f'{{"jobs":{jobs_json},"total":{total},"next_cursor":{json.dumps(next_cursor)}}}'
+    return Response(content=content, media_type="application/json")
 
 @app.get("/api/jobs/{job_id}")
 async def get_job_status(job_id: str):
@@ -128,6 +176,22 @@ async def get_job_status(job_id: str):
     
     return job
 
+@app.post("/api/jobs/{job_id}/frames:batch")
+async def insert_frames_batch(job_id: str, frames: List[FrameRecord]):
+    job = await db_manager.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if not frames:
+        return {"job_id": job_id, "inserted": 0}
+    
+    try:
+        inserted = await db_manager.bulk_insert_frames(job_id, [frame.dict() for frame in frames])
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to insert frames: {str(e)}")
+    
+    return {"job_id": job_id, "inserted": inserted}
+
 @app.get("/api/jobs/{job_id}/download")
 async def download_results(job_id: str):
     job = await db_manager.get_job(job_id)
@@ -141,14 +205,26 @@ async def download_results(job_id: str):
         )
     
     heatmap_path = job.get("heatmap_video_path")
-    if not heatmap_path or not os.path.exists(heatmap_path):
+    if not heatmap_path:
         raise HTTPException(status_code=404, detail="Processed video not found")
     
-    return FileResponse(
-        heatmap_path,
-        media_type="video/mp4",
-        filename=f"heatmap_{job_id}.mp4"
-    )
+    # Jobs finished before outputs moved to S3 still point at a local file
+    if not video_processor.is_s3_output_key(heatmap_path):
+        if not os.path.exists(heatmap_path):
+            raise HTTPException(status_code=404, detail="Processed video not found")
+        
+        return FileResponse(
+            heatmap_path,
+            media_type="video/mp4",
+            filename=f"heatmap_{job_id}.mp4"
+        )
+    
+    try:
+        url = await video_processor.generate_download_url(heatmap_path, f"heatmap_{job_id}.mp4")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to sign download URL: {str(e)}")
+    
+    return RedirectResponse(url, status_code=302)
 
 @app.delete("/api/jobs/{job_id}")
 async def delete_job(job_id: str):
@@ -161,8 +237,12 @@ async def delete_job(job_id: str):
             os.remove(job["file_path"])
         
         heatmap_path = job.get("heatmap_video_path")
-        if heatmap_path and os.path.exists(heatmap_path):
-            os.remove(heatmap_path)
+        # Deduplicated uploads share one heatmap; keep it while others reference it
+        if heatmap_path and not await db_manager.heatmap_in_use(heatmap_path, job_id):
+            if video_processor.is_s3_output_key(heatmap_path):
+                await video_processor.delete_heatmap_video(heatmap_path)
+            elif os.path.exists(heatmap_path):
+                os.remove(heatmap_path)
     except Exception as e:
         print(f"Warning: Failed to delete files for job {job_id}: {e}")
     
@@ -174,73 +254,65 @@ async def process_video(job_id: str, video_path: str, fps: int):
     try:
         await db_manager.update_job_status(job_id, "processing")
         
-        go_script_path = os.path.join("..", "FlyGo", "main.go")
         output_dir = os.path.join("output", job_id)
         
         os.makedirs(output_dir, exist_ok=True)
         
         absolute_video_path = os.path.abspath(video_path)
+        absolute_output_dir = os.path.abspath(output_dir)
         
-        cmd = [
-            "go", "run", go_script_path,
+        # Prefer the prebuilt binary; `go run` recompiles the producer on every job
+        if os.path.exists(FLYGO_BIN):
+            cmd = [FLYGO_BIN]
+        else:
+            cmd = ["go", "run", "main.go"]
+        
+        cmd += [
             absolute_video_path,
-            output_dir,
+            absolute_output_dir,
             str(fps),
             job_id
         ]
         
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            cwd=os.path.join("..", "FlyGo")
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=FLYGO_DIR
         )
+        _, stderr = await proc.communicate()
         
-        if result.returncode != 0:
-            raise Exception(f"Go pipeline failed: {result.stderr}")
+        if proc.returncode != 0:
+            raise Exception(f"Go pipeline failed: {stderr.decode(errors='replace')}")
         
         await wait_for_completion(job_id)
         
-        heatmap_video_path = await video_processor.stitch_heatmap_frames(job_id)
+        local_video_path = await video_processor.stitch_heatmap_frames(job_id)
+        heatmap_video_key = await video_processor.upload_heatmap_video(job_id, local_video_path)
         
-        await db_manager.update_job_completion(job_id, "completed", heatmap_video_path)
+        await db_manager.finalize_job(job_id, "completed", heatmap_video_path=heatmap_video_key)
         
         print(f"Job {job_id} completed successfully!")
         
     except Exception as e:
         print(f"Job {job_id} failed: {str(e)}")
-        await db_manager.update_job_status(job_id, "failed")
-        await db_manager.update_job_error(job_id, str(e))
+        await db_manager.finalize_job(job_id, "failed", error=str(e))
 
 async def wait_for_completion(job_id: str, timeout: int = 300):
-    start_time = datetime.now()
-    
-    while (datetime.now() - start_time).seconds < timeout:
-        frames = await db_manager.get_frames_for_job(job_id)
-        
-        if not frames:
-            await asyncio.sleep(5)
-            continue
-        
-        completed_frames = [f for f in frames if f["status"] in ["completed", "done"]]
-        pending_frames = [f for f in frames if f["status"] in ["pending", "processing"]]
-        failed_frames = [f for f in frames if f["status"] == "failed"]
-        
-        if len(pending_frames) == 0 and len(failed_frames) == 0:
-            return
-        
-        if len(failed_frames) > 0:
-            return
-        
-        await asyncio.sleep(5)
-    
-    raise Exception("Processing timeout exceeded")
+    await db_manager.wait_for_job(job_id, timeout=timeout)
 
 if __name__ == "__main__":
+    # Auto-reload is a dev convenience and only works with a single worker
+    reload = os.getenv("API_RELOAD", "false").lower() == "true"
+    workers = 1 if reload else int(os.getenv("API_WORKERS") or os.cpu_count() or 1)
+    
     uvicorn.run(
         "main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        reload=reload,
         log_level="info"
-    ) 
+    )
@@ -1,20 +1,135 @@
 import cv2
 import os
-import boto3
-import tempfile
+import io
+import aioboto3
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+import shutil
+import subprocess
+import tarfile
 import numpy as np
 from typing import List, Optional, Dict
 from datetime import datetime
 import asyncio
+from contextlib import AsyncExitStack
+from cachetools import LRUCache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+except ImportError:
+    TurboJPEG = None
+
+HEATMAP_OUTPUT_PREFIX = "outputs/"
+VAAPI_DEVICE = os.getenv("FLYBRAIN_VAAPI_DEVICE", "/dev/dri/renderD128")
+
+# (input args, output args) per encoder; input args go before `-i -`
+ENCODER_ARGS = {
+    "libx264": (
+        [],
+        ["-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p"]
+    ),
+    "nvenc": (
+        [],
+        ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ll", "-rc", "cbr", "-b:v", "4M", "-pix_fmt", "yuv420p"]
+    ),
+    "vaapi": (
+        ["-vaapi_device", VAAPI_DEVICE],
+        ["-vf", "format=nv12,hwupload", "-c:v", "h264_vaapi", "-b:v", "4M"]
+    ),
+}
 
 class VideoProcessor:
     def __init__(self):
-        self.s3_client = boto3.client('s3')
+        self.session = aioboto3.Session()
+        self.s3_client = None
+        self._exit_stack = None
         self.s3_bucket = os.getenv("S3_BUCKET", "fly-brain-img01")
+        self.download_concurrency = int(os.getenv("S3_DOWNLOAD_CONCURRENCY", "32"))
+        # Nothing in the pipeline writes per-job tar bundles yet, so probing for one is opt-in
+        self.use_heatmap_archives = os.getenv("S3_HEATMAP_ARCHIVES", "false").lower() == "true"
+        self.s3_config = AioConfig(max_pool_connections=self.download_concurrency)
         self.output_dir = "processed_videos"
+        self.ffmpeg_path = shutil.which("ffmpeg")
+        self.encoder = self.select_encoder()
+        self.tj = self.load_turbojpeg()
+        self.decode_workers = os.cpu_count() or 1
+        self.decode_executor = ThreadPoolExecutor(max_workers=self.decode_workers)
+        self._video_info_cache = LRUCache(maxsize=1024)
         
         os.makedirs(self.output_dir, exist_ok=True)
     
+    async def start(self):
+        # One long-lived client: endpoint/credential resolution happens once, not per request
+        self._exit_stack = AsyncExitStack()
+        self.s3_client = await self._exit_stack.enter_async_context(
+            self.session.client("s3", config=self.s3_config)
+        )
+    
+    async def close(self):
+        if self._exit_stack:
+            await self._exit_stack.aclose()
+            self._exit_stack = None
+            self.s3_client = None
+    
+    def is_s3_output_key(self, path: str) -> bool:
+        return path.startswith(HEATMAP_OUTPUT_PREFIX)
+    
+    def select_encoder(self) -> Optional[str]:
+        if not self.ffmpeg_path:
+            return None
+        
+        requested = os.getenv("FLYBRAIN_ENCODER")
+        if requested in ENCODER_ARGS:
+            return requested
+        if requested:
+            print(f"Unknown FLYBRAIN_ENCODER {requested!r} (allowed: {', '.join(ENCODER_ARGS)}), auto-detecting")
+        
+        # Listing h264_nvenc only means ffmpeg was built with it; a short test
+        # encode confirms a usable GPU is actually present
+        try:
+            encoders = subprocess.run(
+                [self.ffmpeg_path, "-hide_banner", "-encoders"],
+                capture_output=True, text=True, timeout=10
+            ).stdout
+            
+            if "h264_nvenc" in encoders:
+                probe = subprocess.run(
+                    [
+                        self.ffmpeg_path, "-hide_banner", "-loglevel", "error",
+                        "-f", "lavfi", "-i", "color=black:s=256x256:d=0.1",
+                        *ENCODER_ARGS["nvenc"][1], "-f", "null", "-"
+                    ],
+                    capture_output=True, timeout=10
+                )
+                if probe.returncode == 0:
+                    print("Using NVENC for heatmap video encoding")
+                    return "nvenc"
+        except Exception as e:
+            print(f"Encoder probe failed, using libx264: {e}")
+        
+        return "libx264"
+    
+    def load_turbojpeg(self):
+        if TurboJPEG is None:
+            return None
+        
+        try:
+            return TurboJPEG()
+        except Exception as e:
+            print(f"libjpeg-turbo unavailable, falling back to OpenCV decode: {e}")
+            return None
+    
+    def decode_frame(self, data: bytes) -> Optional[np.ndarray]:
+        if self.tj is not None:
+            try:
+                return self.tj.decode(data, pixel_format=TJPF_BGR)
+            except Exception:
+                return None
+        
+        return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    
     async def stitch_heatmap_frames(self, job_id: str, fps: int = 10) -> str:
         try:
             frames = await self.download_heatmap_frames(job_id)
@@ -35,82 +150,214 @@ class VideoProcessor:
     async def download_heatmap_frames(self, job_id: str) -> List[Dict]:
         try:
             prefix = f"heatmaps/{job_id}/"
+            semaphore = asyncio.Semaphore(self.download_concurrency)
             
-            response = self.s3_client.list_objects_v2(
-                Bucket=self.s3_bucket,
-                Prefix=prefix
-            )
+            s3 = self.s3_client
+            if self.use_heatmap_archives:
+                frames = await self.download_heatmap_archive(s3, job_id)
+                if frames is not None:
+                    return frames
             
-            frames = []
+            keys = []
+            paginator = s3.get_paginator("list_objects_v2")
+            async for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    if "_heatmap.jpg" in obj["Key"]:
+                        keys.append(obj["Key"])
             
-            if "Contents" in response:
-                for obj in response["Contents"]:
-                    key = obj["Key"]
-                    
-                    if "_heatmap.jpg" in key:
-                        frame_number_str = key.split("frame_")[1].split("_heatmap")[0]
-                        frame_number = int(frame_number_str)
-                        
-                        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-                        temp_file.close()
-                        
-                        self.s3_client.download_file(
-                            self.s3_bucket,
-                            key,
-                            temp_file.name
-                        )
-                        
-                        frames.append({
-                            "frame_number": frame_number,
-                            "s3_key": key,
-                            "local_path": temp_file.name
-                        })
-            
-            return frames
+            async def download_one(key: str) -> Dict:
+                frame_number = self.parse_frame_number(key)
+                
+                async with semaphore:
+                    response = await s3.get_object(Bucket=self.s3_bucket, Key=key)
+                    async with response["Body"] as body:
+                        data = await body.read()
+                
+                return {
+                    "frame_number": frame_number,
+                    "s3_key": key,
+                    "data": data
+                }
+            
+            frames = await asyncio.gather(*(download_one(key) for key in keys))
+            
+            return list(frames)
             
         except Exception as e:
             print(f"Failed to download heatmap frames: {e}")
             return []
     
+    async def download_heatmap_archive(self, s3, job_id: str) -> Optional[List[Dict]]:
+        # One GET for the whole job when a bundle exists; None means fall back to per-frame objects
+        key = f"heatmaps/{job_id}.tar"
+        
+        try:
+            response = await s3.get_object(Bucket=self.s3_bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise
+        
+        # The archive is buffered in memory (it holds the same bytes the frame list
+        # keeps anyway) and then extracted, rather than streamed member by member
+        async with response["Body"] as body:
+            data = await body.read()
+        
+        frames = []
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:") as archive:
+            for member in archive:
+                if not member.isfile() or "_heatmap.jpg" not in member.name:
+                    continue
+                
+                frames.append({
+                    "frame_number": self.parse_frame_number(member.name),
+                    "s3_key": f"{key}/{member.name}",
+                    "data": archive.extractfile(member).read()
+                })
+        
+        return frames
+    
+    def parse_frame_number(self, name: str) -> int:
+        frame_number_str = os.path.basename(name).split("frame_")[1].split("_heatmap")[0]
+        return int(frame_number_str)
+    
     async def create_video_from_frames(self, frames: List[Dict], job_id: str, fps: int) -> str:
         try:
             if not frames:
                 raise Exception("No frames provided for video creation")
             
-            first_frame = cv2.imread(frames[0]["local_path"])
-            if first_frame is None:
-                raise Exception(f"Failed to read first frame: {frames[0]['local_path']}")
-            
-            height, width, layers = first_frame.shape
-            
             output_path = os.path.join(self.output_dir, f"heatmap_{job_id}.mp4")
             
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            video_writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+            if self.ffmpeg_path:
+                await self.encode_with_ffmpeg(frames, output_path, fps)
+            else:
+                await asyncio.to_thread(self.encode_with_opencv, frames, output_path, fps)
             
-            if not video_writer.isOpened():
-                raise Exception("Failed to create video writer")
+            return output_path
             
+        except Exception as e:
+            print(f"Failed to create video: {e}")
+            raise
+    
+    async def encode_with_ffmpeg(self, frames: List[Dict], output_path: str, fps: int):
+        input_args, output_args = ENCODER_ARGS[self.encoder]
+        
+        cmd = [
+            self.ffmpeg_path, "-y", "-loglevel", "error",
+            *input_args,
+            "-framerate", str(fps),
+            "-f", "image2pipe", "-c:v", "mjpeg", "-i", "-",
+            *output_args,
+            output_path
+        ]
+        
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        
+        # Drain stderr while writing; if ffmpeg fills the stderr pipe (e.g. one error
+        # per corrupt frame) it stops reading stdin and drain() would block forever
+        stderr_task = asyncio.create_task(proc.stderr.read())
+        
+        try:
             for frame_info in frames:
-                frame = cv2.imread(frame_info["local_path"])
+                proc.stdin.write(frame_info["data"])
+                await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg exited early; its stderr below says why
+            pass
+        except BaseException:
+            proc.kill()
+            await proc.wait()
+            stderr_task.cancel()
+            raise
+        finally:
+            proc.stdin.close()
+        
+        stderr = await stderr_task
+        await proc.wait()
+        
+        if proc.returncode != 0:
+            raise Exception(f"ffmpeg failed: {stderr.decode(errors='replace').strip()}")
+    
+    def encode_with_opencv(self, frames: List[Dict], output_path: str, fps: int):
+        first_frame = self.decode_frame(frames[0]["data"])
+        if first_frame is None:
+            raise Exception(f"Failed to decode first frame: {frames[0]['s3_key']}")
+        
+        height, width, layers = first_frame.shape
+        
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        video_writer = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
+        
+        if not video_writer.isOpened():
+            raise Exception("Failed to create video writer")
+        
+        # Decode ahead on the pool while frames are written in order; the window
+        # bounds how many decoded frames are held in memory at once
+        max_in_flight = 2 * self.decode_workers
+        in_flight = deque()
+        
+        try:
+            video_writer.write(first_frame)
+            
+            for frame_info in frames[1:]:
+                in_flight.append(self.decode_executor.submit(self.decode_frame, frame_info["data"]))
+                if len(in_flight) >= max_in_flight:
+                    frame = in_flight.popleft().result()
+                    if frame is not None:
+                        video_writer.write(frame)
+            
+            while in_flight:
+                frame = in_flight.popleft().result()
                 if frame is not None:
                     video_writer.write(frame)
-            
+        finally:
             video_writer.release()
+    
+    async def upload_heatmap_video(self, job_id: str, local_path: str) -> str:
+        key = f"{HEATMAP_OUTPUT_PREFIX}{job_id}.mp4"
+        
+        try:
+            await self.s3_client.upload_file(
+                local_path,
+                self.s3_bucket,
+                key,
+                ExtraArgs={"ContentType": "video/mp4"}
+            )
             
-            for frame_info in frames:
-                try:
-                    os.unlink(frame_info["local_path"])
-                except:
-                    pass
-            
-            return output_path
+            os.unlink(local_path)
+            return key
             
         except Exception as e:
-            print(f"Failed to create video: {e}")
+            print(f"Failed to upload heatmap video: {e}")
             raise
     
+    async def generate_download_url(self, key: str, filename: str, expires_in: int = 3600) -> str:
+        return await self.s3_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.s3_bucket,
+                "Key": key,
+                "ResponseContentDisposition": f'attachment; filename="{filename}"'
+            },
+            ExpiresIn=expires_in
+        )
+    
+    async def delete_heatmap_video(self, key: str):
+        await self.s3_client.delete_object(Bucket=self.s3_bucket, Key=key)
+    
     async def get_video_info(self, video_path: str) -> Dict:
+        try:
+            cache_key = (video_path, os.path.getmtime(video_path))
+        except OSError:
+            cache_key = None
+        
+        if cache_key in self._video_info_cache:
+            return dict(self._video_info_cache[cache_key])
+        
         try:
             cap = cv2.VideoCapture(video_path)
             
@@ -125,7 +372,7 @@ class VideoProcessor:
             
             cap.release()
             
-            return {
+            info = {
                 "fps": fps,
                 "frame_count": frame_count,
                 "width": width,
@@ -134,6 +381,11 @@ class VideoProcessor:
                 "file_size": os.path.getsize(video_path) if os.path.exists(video_path) else 0
             }
             
+            if cache_key is not None:
+                self._video_info_cache[cache_key] = info
+            
+            return dict(info)
+            
         except Exception as e:
             print(f"Failed to get video info: {e}")
             return {}